@@ -5,83 +5,144 @@ Debugbot echoes back everything the server sent for easier debugging.
 """
 from __future__ import annotations
 
-import asyncio
-from typing import Any, AsyncIterator, Callable, Generic, Optional, TypeVar
-
-from aiohttp import web
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Generic,
+    Optional,
+    TypeVar,
+)
 
 from aiohttp_poe import PoeBot, run
 from aiohttp_poe.types import (
     ContentType,
     Event,
     QueryRequest,
+    ReportErrorRequest,
     ReportFeedbackRequest,
+    SettingsRequest,
     SettingsResponse,
 )
-from collections import Counter
-import copy
+from collections import OrderedDict
 from dataclasses import dataclass
 from enum import Enum
 import json
+import re
+from types import MappingProxyType
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if TYPE_CHECKING:
+    from aiohttp import web
 
 
+# Maximum number of distinct `error` messages to track retries for.
+MAX_TRACKED_ERROR_MESSAGES = 1024
 ALLOWED_CONTENT_TYPES = {"text/markdown", "text/plain"}
-ALL_COMMANDS = {
-    "commands": "Lists available commands this bot can use.",
-    "assign <option>=<value>": "Update a bot option.",
-    "options": "Lists available options you can set and their current values.",
-    "reset": "Resets the bot back to all default options.",
-    'error [retries] "<message>"': (
+ALL_COMMANDS = (
+    ("commands", "Lists available commands this bot can use."),
+    ("assign <option>=<value>", "Update a bot option."),
+    ("options", "Lists available options you can set and their current values."),
+    ("reset", "Resets the bot back to all default options."),
+    (
+        'error [retries] "<message>"',
         "Makes the bot emit an error back to the Poe server with the given "
         "error message (as a JSON string). The optional argument `retries` "
         "specifies the maximum number of times you want Poe to send the "
         "request. (Underneath, the bot server will keep track of the number "
         "of times it's seen this exact message and respond with "
         "allow_retry=False when there are no retries remaining). By default, "
-        "`retries` is 0."
+        "`retries` is 0.",
     ),
-}
+)
+_ALL_COMMANDS_TEXT = "".join(
+    f"{command}: {description}\n" for command, description in ALL_COMMANDS
+)
+# Commands that take no arguments can be sent as-is as suggested replies.
+_DEFAULT_SUGGESTED_REPLY = tuple(
+    command for command, _ in ALL_COMMANDS if " " not in command
+)
+# Maps each command to the name of the DebugBot method that handles it. The
+# methods are looked up on the instance so subclasses can override them.
+_COMMANDS = MappingProxyType(
+    {
+        "commands": "_list_commands",
+        "assign": "_handle_option_assignment",
+        "options": "_list_options",
+        "reset": "_reset",
+        "error": "_error",
+    }
+)
+# Matches a leading word that is short enough to be a command, along with the
+# whitespace separating it from its arguments.
+_COMMAND_RE = re.compile(rf"\s*([A-Za-z]{{1,{max(map(len, _COMMANDS))}}})(?:\s+|\Z)")
 
 T = TypeVar("T")
 
+
+def _json_loads(value: str | bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
+
+
+def _json_dumps(obj: Any, *, code_block: bool = False) -> str:
+    """Pretty-print obj as JSON, optionally wrapped in a markdown code block."""
+    if orjson is not None:
+        buf = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        if code_block:
+            buf = b"```\n" + buf + b"\n```"
+        return buf.decode()
+    text = json.dumps(obj, indent=2, ensure_ascii=False)
+    return f"```\n{text}\n```" if code_block else text
+
+
 @dataclass
 class OptionsInfo(Generic[T]):
     description: str
     default_value: T
-    parser: Callable[[T, str], T]
+    parser: Callable[[str, T, str], T]
 
 
-def _parse_bool(old_value: bool, value: str) -> bool:
+def _parse_bool(key: str, old_value: bool, value: str) -> bool:
     return value.lower() == "true"
 
-def _parse_content_type(old_value: ContentType, value: str) -> ContentType:
+def _parse_content_type(key: str, old_value: ContentType, value: str) -> ContentType:
     assert value in ALLOWED_CONTENT_TYPES, f"value must be in {ALLOWED_CONTENT_TYPES}"
     return value
 
-def _parse_optional_nonnegative_int(old_value: Optional[int], value: str) -> Optional[int]:
+def _parse_optional_nonnegative_int(
+    key: str, old_value: Optional[int], value: str
+) -> Optional[int]:
     if value.lower() in {"none", "null"}:
         return None
     new_value = int(value)
     assert new_value >= 0, f"expected a non-negative integer, got {new_value}"
     return new_value
 
-def _parse_list_str(old_value: list[str], value: str) -> list[str]:
+def _parse_list_str(key: str, old_value: list[str], value: str) -> list[str]:
     if value.startswith("["):
-        new_value = json.loads(value)
+        new_value = _json_loads(value)
         assert isinstance(
             new_value, list
         ), f"{key} should be a list, got {type(new_value)}"
-        types = [type(r) for r  in new_value]
-        assert all(t is bool for t in types), f"expected a list of strings, got {types}"
+        assert all(
+            isinstance(r, str) for r in new_value
+        ), f"{key} should be a list of strings, got {new_value}"
     elif value.startswith("+"):
-        addition = json.loads(value[1:])
+        addition = _json_loads(value[1:])
         assert isinstance(
             addition, str
         ), f"can only add strings to {key}, got {type(addition)}"
         assert addition not in old_value, f"{addition} is already in {key}"
         new_value = old_value + [addition]
     elif value.startswith("-"):
-        to_remove = json.loads(value[1:])
+        to_remove = _json_loads(value[1:])
         assert isinstance(
             to_remove, str
         ), f"can only remove strings from {key}, got {type(to_remove)}"
@@ -155,85 +216,130 @@ class BotOptions(Enum):
             '- -"<reply>": remove the given reply to the list. Example: '
             'suggested_reply=-"existing reply"\n'
         ),
-        default_value=list(cmd for cmd in ALL_COMMANDS if " " not in cmd),
+        default_value=list(_DEFAULT_SUGGESTED_REPLY),
         parser=_parse_list_str,
     )
 
 
+_DEFAULT_OPTIONS = MappingProxyType(
+    {opt.name: opt.value.default_value for opt in BotOptions}
+)
+_OPTION_PARSERS = MappingProxyType({opt.name: opt.value.parser for opt in BotOptions})
+
+
 class DebugBot(PoeBot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.requests: list[QueryRequest] = []
-        self.commands = {
-            "commands": self._list_commands,
-            "assign": self._handle_option_assignment,
-            "options": self._list_options,
-            "reset": self._reset,
-            "error": self._error,
-        }
-        self.options = {
-            opt.name: opt.value.default_value
-            for opt in BotOptions
-        }
-        self.error_message_counts = Counter()
+        # Requests are stored as-is rather than copied, so nothing may mutate
+        # a request object after it has been handed to the bot.
+        self.requests: list[
+            QueryRequest | ReportFeedbackRequest | ReportErrorRequest | SettingsRequest
+        ] = []
+        self.options: dict[str, Any] = dict(_DEFAULT_OPTIONS)
+        self.error_message_counts: OrderedDict[str, int] = OrderedDict()
+        # Built from the suggested_reply option on demand; None when stale.
+        self._suggested_reply_events: Optional[list[Event]] = None
+        # Events for fixed messages are built once; the events are only ever
+        # serialized, never modified.
+        self._all_commands_event = self.text_event(_ALL_COMMANDS_TEXT)
+        self._assign_usage_event = self.text_event(
+            "`assign` requires an argument of the form <option_name>=<value>."
+        )
+        self._error_usage_event = self.text_event(
+            "WARNING: `error` expects at least one argument."
+        )
+        self._error_parse_failure_event = self.text_event(
+            "Could not parse `error` arguments. It needs to be in the "
+            "form `error [retries] <message>"
+        )
 
     async def get_response(
         self, query: QueryRequest, request: web.Request
     ) -> AsyncIterator[Event]:
         """Return an async iterator of events to send to the user."""
-        if self._get_option(BotOptions.send_meta_event):
-            yield self.meta_event(
-                content_type=self._get_option(BotOptions.content_type),
-                linkify=self._get_option(BotOptions.linkify),
-                refetch_settings=self._get_option(BotOptions.refetch_settings),
-            )
-        query_data = copy.deepcopy(query)
-        last_message = query_data["query"][-1]["content"].strip()
-        cmd, *args = last_message.split(None, 1)
-        if (handler := self.commands.get(cmd.lower())) is not None:
-            async for ev in handler(query_data, *args):
-                yield ev
-        else:
-            yield self.text_event(f"{last_message}\n")
-
-        if self._get_option(BotOptions.skip_bot_messages):
-            query_data["query"] = [q for q in query_data["query"] if q["role"] != "bot"]
+        for ev in self._build_events(query):
+            yield ev
 
-        if (n_prev := self._get_option(BotOptions.n_previous_messages)) is not None:
-            query_data["query"] = query_data["query"][-n_prev:]
+    def _build_events(self, query: QueryRequest) -> list[Event]:
+        """Build all the events for a response.
+
+        None of the commands need to await anything, so the whole response is
+        built up front instead of suspending the generator for every event.
+        """
+        events: list[Event] = []
+        opts = self.options
+        if opts["send_meta_event"]:
+            events.append(
+                self.meta_event(
+                    content_type=opts["content_type"],
+                    linkify=opts["linkify"],
+                    refetch_settings=opts["refetch_settings"],
+                )
+            )
+        # Only the top-level "query" list is replaced below, so a shallow copy
+        # is enough to leave the original request untouched.
+        query_data = query.copy()
+        content = query_data["query"][-1]["content"]
+        handler_name = None
+        # The regex only looks at the first word, so long messages that are
+        # not commands are not split or copied.
+        match = _COMMAND_RE.match(content)
+        if match is not None:
+            cmd = match.group(1)
+            # Commands are all lowercase, so skip allocating a lowered copy when possible.
+            handler_name = _COMMANDS.get(cmd if cmd.islower() else cmd.lower())
+            if handler_name is not None:
+                handler = getattr(self, handler_name)
+                end = match.end()
+                events.extend(handler(query_data, content[end:].rstrip()))
+        if handler_name is None:
+            events.append(self.text_event(f"{content.strip()}\n"))
+
+        # The command may have changed or reset the options.
+        opts = self.options
+        skip_bot_messages = opts["skip_bot_messages"]
+        n_prev = opts["n_previous_messages"]
+        messages = query_data["query"]
+        if skip_bot_messages:
+            # Walk back from the latest message so we stop once we have enough.
+            limit = len(messages) if n_prev is None else n_prev
+            kept = []
+            for message in reversed(messages):
+                if len(kept) >= limit:
+                    break
+                if message["role"] != "bot":
+                    kept.append(message)
+            kept.reverse()
+            query_data["query"] = kept
+        elif n_prev is not None:
+            query_data["query"] = messages[-n_prev:] if n_prev else []
 
         self.requests.append(query_data)
-        request_str = json.dumps(
-            self.requests[0]
-            if len(self.requests) == 1
-            else self.requests,
-            indent=4,
-        )
-        self.requests = []
-        yield self.text_event(
-            f"```\n{request_str}\n```"
-            if self._get_option(BotOptions.content_type) == "text/markdown"
-            else request_str
+        requests, self.requests = self.requests, []
+        request_str = _json_dumps(
+            requests[0] if len(requests) == 1 else requests,
+            code_block=opts["content_type"] == "text/markdown",
         )
+        events.append(self.text_event(request_str))
 
-        for reply in self._get_option(BotOptions.suggested_reply):
-            yield self.suggested_reply_event(reply)
+        events.extend(self._get_suggested_reply_events())
+        return events
 
     async def on_feedback(self, feedback: ReportFeedbackRequest) -> None:
         """Called when we receive user feedback such as likes."""
-        self.requests.append(copy.deepcopy(feedback))
+        self.requests.append(feedback)
         print(
             f"User {feedback['user_id']} gave feedback on {feedback['conversation_id']}"
             f"message {feedback['message_id']}: {feedback['feedback_type']}"
         )
 
     async def on_error(self, error: ReportErrorRequest) -> None:
-        super().on_error(error)
-        self.requests.append(copy.deepcopy(error))
+        await super().on_error(error)
+        self.requests.append(error)
 
     async def get_settings(self, request: SettingsRequest) -> SettingsResponse:
         """Return the settings for this bot."""
-        self.requests.append(copy.deepcopy(request))
+        self.requests.append(request)
         return {
             "context_clear_window_secs": self._get_option(BotOptions.context_clear_window_secs),
             "allow_user_context_clear": self._get_option(BotOptions.allow_user_context_clear),
@@ -243,93 +349,104 @@ class DebugBot(PoeBot):
         return self.options[opt.name]
 
     def _set_option(self, key: str, value: str) -> None:
-        old_value = self.options[key]
-        new_value = BotOptions[key].value.parser(old_value, value)
-        self.options[key] = new_value
-
-    async def _handle_option_assignment(self, query: QueryRequest, *args) -> AsyncIterator[Event]:
-        if len(args) != 1:
-            yield self.text_event(
-                f"`assign` requires an argument of the form <option_name>=<value>."
-            )
-            return
-        lvalue, assignment, rvalue = args[0].partition("=")
+        self.options[key] = _OPTION_PARSERS[key](key, self.options[key], value)
+        if key == BotOptions.suggested_reply.name:
+            self._suggested_reply_events = None
+
+    def _get_suggested_reply_events(self) -> list[Event]:
+        if self._suggested_reply_events is None:
+            self._suggested_reply_events = [
+                self.suggested_reply_event(reply)
+                for reply in self._get_option(BotOptions.suggested_reply)
+            ]
+        return self._suggested_reply_events
+
+    def _handle_option_assignment(self, query: QueryRequest, args: str) -> list[Event]:
+        if not args:
+            return [self._assign_usage_event]
+        lvalue, assignment, rvalue = args.partition("=")
         if assignment != "=":
-            yield self.text_event(
-                f"`assign` requires an argument of the form <option_name>=<value>."
-            )
-            return
+            return [self._assign_usage_event]
 
         key = lvalue.lower().strip()
-        if key not in self.options:
-            yield self.text_event(f"Option '{key}' does not exist!\n")
-        else:
-            try:
-                self._set_option(key, rvalue)
-                yield self.text_event(f"Set option {key}={self.options[key]}.\n")
-            except Exception as e:
-                yield self.text_event(
-                    f"Could not set option {key} due to error {repr(e)}.\n"
+        if key not in _OPTION_PARSERS:
+            return [self.text_event(f"Option '{key}' does not exist!\n")]
+        try:
+            self._set_option(key, rvalue)
+            return [self.text_event(f"Set option {key}={self.options[key]}.\n")]
+        except Exception as e:
+            return [
+                self.text_event(f"Could not set option {key} due to error {repr(e)}.\n")
+            ]
+
+    def _list_options(self, query: QueryRequest, args: str = "") -> list[Event]:
+        events: list[Event] = []
+        if args:
+            events.append(
+                self.text_event(
+                    f"WARNING: `options` does not take arguments, but got '{args}'."
                 )
-
-    async def _list_options(self, query: QueryRequest, *args) -> AsyncIterator[Event]:
-        if len(args) != 0:
-            yield self.text_event(
-                f"WARNING: `options` does not take arguments, but got '{args}'."
             )
-        for key, value in self.options.items():
-            yield self.text_event(f"{key}={value}\n")
-
-    async def _list_commands(self, query: QueryRequest, *args) -> AsyncIterator[Event]:
-        if len(args) != 0:
-            yield self.text_event(
-                f"WARNING: `command` does not take arguments, but got '{args}'."
+        events.append(
+            self.text_event(
+                "".join(f"{key}={value}\n" for key, value in self.options.items())
             )
-        for command, description in ALL_COMMANDS.items():
-            yield self.text_event(f"{command}: {description}\n")
-
-    async def _reset(self, query: QueryRequest, *args) -> AsyncIterator[Event]:
-        if len(args) != 0:
-            yield self.text_event(
-                f"WARNING: `command` does not take arguments, but got '{args}'."
+        )
+        return events
+
+    def _list_commands(self, query: QueryRequest, args: str) -> list[Event]:
+        events: list[Event] = []
+        if args:
+            events.append(
+                self.text_event(
+                    f"WARNING: `command` does not take arguments, but got '{args}'."
+                )
             )
-        self.options = {
-            opt.name: opt.value.default_value
-            for opt in BotOptions
-        }
-        async for ev in self._list_options(query):
-            yield ev
-
-    async def _error(self, query: QueryRequest, *args) -> AsyncIterator[Event]:
-        if len(args) != 1:
-            yield self.text_event(
-                f"WARNING: `error` expects at least one argument."
+        events.append(self._all_commands_event)
+        return events
+
+    def _reset(self, query: QueryRequest, args: str) -> list[Event]:
+        events: list[Event] = []
+        if args:
+            events.append(
+                self.text_event(
+                    f"WARNING: `command` does not take arguments, but got '{args}'."
+                )
             )
-            return
-        arg_str = args[0]
-        retries, *cmd_args = arg_str.split(None, 1)
-        try:
-            retries = _parse_optional_nonnegative_int(0, retries) or 0
-            message = json.loads(cmd_args[0])
-        except Exception as e:
+        self.options = dict(_DEFAULT_OPTIONS)
+        self._suggested_reply_events = None
+        events.extend(self._list_options(query))
+        return events
+
+    def _error(self, query: QueryRequest, arg_str: str) -> list[Event]:
+        if not arg_str:
+            return [self._error_usage_event]
+        first, *rest = arg_str.split(None, 1)
+        # Only treat the first token as the retry count if it looks like one,
+        # so the message is parsed exactly once.
+        digits = first[1:] if first.startswith("+") else first
+        if rest and first.lower() in {"none", "null"}:
             retries = 0
-            try:
-                message = json.loads(arg_str)
-            except Exception as e:
-                yield self.text_event(
-                    "Could not parse `error` arguments. It needs to be in the "
-                    "form `error [retries] <message>"
-                )
-                return
-
-        if arg_str in self.error_message_counts:
-            self.error_message_counts[arg_str] -= 1
+            message_str = rest[0]
+        elif rest and digits.isdecimal():
+            retries = int(digits)
+            message_str = rest[0]
         else:
-            self.error_message_counts[arg_str] = retries
-
-        yield self.error_event(
-            message, allow_retry=self.error_message_counts[arg_str] > 0
-        )
+            retries = 0
+            message_str = arg_str
+        try:
+            message = _json_loads(message_str)
+        except Exception:
+            return [self._error_parse_failure_event]
+
+        count = self.error_message_counts.get(arg_str)
+        count = retries if count is None else count - 1
+        self.error_message_counts[arg_str] = count
+        self.error_message_counts.move_to_end(arg_str)
+        if len(self.error_message_counts) > MAX_TRACKED_ERROR_MESSAGES:
+            self.error_message_counts.popitem(last=False)
+
+        return [self.error_event(message, allow_retry=count > 0)]
 
 
 if __name__ == "__main__":